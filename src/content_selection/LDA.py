@@ -1,10 +1,24 @@
 import os
+import copy
 import json
+import heapq
+import hashlib
 import argparse
+import tempfile
+import gensim
+import numpy as np
+from scipy import sparse
 from gensim import corpora
 from gensim.utils import simple_preprocess
 from gensim.models import LdaModel
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+
+# scores combined into the total of a sentence, and the ones normalized per topic cluster
+SCORE_NAMES = ['tf_idf', 'concreteness', 'LDAscore']
+NORMALIZED_SCORES = ['tf_idf', 'concreteness']
 
 
 # reaad json file
@@ -38,138 +52,271 @@ def get_corpus_topics(text, lda_model):
     return doc_topic_dist
 
 
-def lda_analysis(input_data, num_topics=3, random_state=1):
-    
-    # treat each set of documents as a separate corpus and find topics?
-    for key, value in input_data.items():
-        _texts = []
-        for k, v in input_data[key].items():
-            _texts.append(' '.join(input_data[key][k]['lemmas']))
+def get_topic_term_matrix(lda_model, num_words=100):
+    '''
+    numeric version of lda_model.show_topics(num_words=num_words)
+    :return: topics x vocabulary matrix with the probabilities of the num_words most probable terms
+    of each topic, rounded to 3 decimals as show_topics prints them, and 0 for the other terms
+    '''
+    topic_term_matrix = np.zeros((lda_model.num_topics, len(lda_model.id2word)))
+    for topic in range(lda_model.num_topics):
+        for term_id, prob in lda_model.get_topic_terms(topic, topn=num_words):
+            topic_term_matrix[topic, term_id] = float('%.3f' % prob)
+    return topic_term_matrix
+
+
+def get_sentence_term_matrix(lemma_lists, dictionary):
+    '''
+    :param lemma_lists: the lemmas of each sentence
+    :return: sparse sentences x vocabulary matrix, 1 if the sentence contains the term
+    '''
+    rows = []
+    columns = []
+    for row, lemmas in enumerate(lemma_lists):
+        for lemma in set(lemmas):
+            if lemma in dictionary.token2id:
+                rows.append(row)
+                columns.append(dictionary.token2id[lemma])
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(lemma_lists), len(dictionary)))
+
+
+def get_model_key(texts, num_topics, random_state, base_key=None):
+    '''
+    :param texts: the tokenized lemmas the model is trained on
+    :param base_key: key of the model that is updated with texts, None for a model trained from scratch
+    :return: hash of everything that determines the trained LDA model
+    '''
+    content = [texts, num_topics, random_state, gensim.__version__]
+    if base_key is not None:
+        content.append(base_key)
+    content = json.dumps(content)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def train_lda_model(texts, num_topics=3, random_state=1, model_cache_dir=None, base=None):
+    '''
+    trains an LDA model, or loads it from model_cache_dir if the same model was trained before
+    :param texts: the tokenized lemmas of every sentence
+    :param model_cache_dir: directory of the saved models, None to always train
+    :param base: optional (LdaModel, key) of a trained model, which is copied and updated online with
+    texts instead of training from scratch. The vocabulary of the base model is kept, so terms that
+    only occur in texts are ignored
+    :return: the LdaModel and its key
+    '''
+    model_key = get_model_key(texts, num_topics, random_state, None if base is None else base[1])
+    model_dir = None if model_cache_dir is None else os.path.join(model_cache_dir, model_key)
+    if model_dir is not None and os.path.exists(model_dir):
+        return LdaModel.load(os.path.join(model_dir, "lda")), model_key
 
-        texts = [simple_preprocess(doc) for doc in _texts]
+    if base is None:
         dictionary = corpora.Dictionary(texts)
         corpus = [dictionary.doc2bow(line) for line in texts]
-
-        # build lda model:
         lda_model = LdaModel(corpus=corpus, id2word=dictionary, num_topics=num_topics, random_state=random_state)
+    else:
+        lda_model = copy.deepcopy(base[0])
+        lda_model.update([lda_model.id2word.doc2bow(line) for line in texts])
+
+    if model_dir is not None:
+        # gensim writes a model to several files, so they are saved in a temporary directory that is
+        # renamed once complete
+        os.makedirs(model_cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=model_cache_dir, suffix=".tmp")
+        lda_model.save(os.path.join(tmp_dir, "lda"))
+        try:
+            os.rename(tmp_dir, model_dir)
+        except OSError:
+            # another process saved the same model first
+            for filename in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, filename))
+            os.rmdir(tmp_dir)
+    return lda_model, model_key
+
+
+def score_cluster(cluster, num_topics=3, random_state=1, diagnostics=False, model_cache_dir=None, base=None,
+                  return_model=False):
+    '''
+    trains an LDA model on one topic cluster and scores its sentences against the LDA topics
+    :param cluster: dictionary of sentence -> sentence info of one topic cluster
+    :param diagnostics: also infer the topic distribution of the whole cluster
+    :param model_cache_dir: directory where trained models are saved and reused, None to disable
+    :param base: optional (LdaModel, key) to warm start from, see train_lda_model
+    :param return_model: also return the model, e.g. to warm start another cluster from it
+    :return: dictionary of sentence -> (LDA score, id of the best scoring LDA topic),
+    the output of get_corpus_topics if diagnostics is True, otherwise None,
+    and the (LdaModel, key) of the cluster if return_model is True, otherwise None
+    '''
+    _texts = []
+    for k, v in cluster.items():
+        _texts.append(' '.join(cluster[k]['lemmas']))
 
-        # get document topic distribution:
-        doc_topic_dist = get_corpus_topics(_texts, lda_model)
-
-        topic_terms = lda_model.show_topics(num_words=100)
-        # get top words for each topic:
-        topic_term_dict = OrderedDict()
-        rel_terms = []
-        for topic_dist in topic_terms:
-            topic_id = topic_dist[0]
-            topic_term_dict[topic_id] = {}
-            topic_terms = topic_dist[1]
-            for _split in topic_terms.split('+'):
-                topic_term_prob = _split.split('*')[0]
-                topic_term = str(_split.split('*')[1]).replace('"', '').strip()
-                topic_term_dict[topic_id][topic_term] = float(topic_term_prob)
-                # rel_terms.append(topic_term)
-
-        summary_sentences = {}
-        sen_ranker = []
-        # calculate rank for each sentence with respect to each topic:
-        for k, v in input_data[key].items():
-            sen = k
-            # sen = sen.lower()
-            sen_length = len(sen.split(' '))
-            sen_id = input_data[key][sen]['doc_id']
-            if sen_length <= 7:
-                continue
-            sen_topic = []
-            # compute score for each topic:
-            for topic in range(num_topics):
-                rel_sen_terms = list(set(input_data[key][k]['lemmas']) & set(topic_term_dict[topic].keys()))
-                sen_score = 0
-                for term in rel_sen_terms:
-                    sen_score += topic_term_dict[topic][term]
-
-                sen_topic.append((topic, sen_score, sen, sen_id))
-
-            # select top one from sen_topic and append to sen_ranker:
-            top_sen_topic = sorted(sen_topic, key=lambda x: x[1], reverse=True)[0]
-            sen_ranker.append(top_sen_topic)
-
-        for _sen in sen_ranker:
-            topic = _sen[0]
-            sen_score = _sen[1]
-            sen = _sen[2]
-            sen_id = _sen[3]
+    texts = [simple_preprocess(doc) for doc in _texts]
+
+    # build lda model:
+    lda_model, model_key = train_lda_model(texts, num_topics, random_state, model_cache_dir, base)
+
+    # get document topic distribution, only used for diagnostics:
+    doc_topic_dist = get_corpus_topics(_texts, lda_model) if diagnostics else None
+
+    # score every sentence against every topic with one sparse product:
+    sentences = [sen for sen in cluster.keys() if len(sen.split(' ')) > 7]
+    topic_term_matrix = get_topic_term_matrix(lda_model, num_words=100)
+    sentence_term_matrix = get_sentence_term_matrix([cluster[sen]['lemmas'] for sen in sentences],
+                                                    lda_model.id2word)
+    # the probabilities have 3 decimals, so their sums do too: rounding removes the floating point
+    # error of the summation order, and ties go to the lowest topic id
+    sen_topic_scores = np.round(sentence_term_matrix.dot(topic_term_matrix.T), 3)
+
+    # select the top scoring topic of each sentence:
+    top_topics = np.argmax(sen_topic_scores, axis=1) if sentences else []
+    scores = {sen: (float(sen_topic_scores[i, topic]), int(topic)) for i, (sen, topic) in enumerate(zip(sentences, top_topics))}
+    return scores, doc_topic_dist, (lda_model, model_key) if return_model else None
+
+
+def get_base_topic_id(topic_id):
+    '''
+    :return: the topic id of docset A for the topic id of an update docset B (see data_loader), otherwise None
+    '''
+    if topic_id.endswith("-B"):
+        return topic_id[:-len("-B")]
+    return None
+
+
+def lda_analysis(input_data, num_topics=3, random_state=1, workers=1, diagnostics=None, model_cache_dir=None,
+                 update=False):
+    '''
+    treats each topic cluster as a separate corpus and adds the LDAscore and lda_topic_id
+    of its sentences
+    :param workers: number of processes that train the per-cluster models, every model is
+    trained with the same random_state so the scores do not depend on it
+    :param diagnostics: optional dictionary, if given the document topic distribution of each
+    cluster (see get_corpus_topics) is computed and stored in it under the cluster's key
+    :param model_cache_dir: directory where trained models are saved and reused, None to disable
+    :param update: update summarization, the model of a docset B cluster is the model of its docset A
+    cluster updated with the B sentences, so the A clusters are trained first
+    '''
+    base_ids = {}
+    if update:
+        base_ids = {key: get_base_topic_id(key) for key in input_data.keys() if get_base_topic_id(key) in input_data}
+    stages = [[key for key in input_data.keys() if key not in base_ids], [key for key in base_ids]]
+    with_diagnostics = diagnostics is not None
+
+    results = {}
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for keys in stages:
+            clusters = [input_data[key] for key in keys]
+            bases = [results[base_ids[key]][2] if key in base_ids else None for key in keys]
+            # models are only sent back from the workers when a B cluster is warm started from them
+            return_models = [key in base_ids.values() for key in keys]
+            arguments = (clusters, repeat(num_topics), repeat(random_state), repeat(with_diagnostics),
+                         repeat(model_cache_dir), bases, return_models)
+            if executor is not None:
+                results.update(zip(keys, executor.map(score_cluster, *arguments)))
+            else:
+                results.update(zip(keys, map(score_cluster, *arguments)))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for key in input_data.keys():
+        cluster_scores, doc_topic_dist, _ = results[key]
+        if with_diagnostics:
+            diagnostics[key] = doc_topic_dist
+        for sen, (sen_score, topic) in cluster_scores.items():
             input_data[key][sen].update({"LDAscore": sen_score})
             input_data[key][sen].update({"lda_topic_id": topic})
 
     return input_data
 
 
-def update_scores(dic):
+def update_scores(dic, weights=None):
     '''
-    Updates the sentence scores in the dictionary by combining tf-idf, concreteness and LDA scoring
+    Updates the sentence scores in the dictionary by combining tf-idf, concreteness and LDA scoring.
+    tf-idf and concreteness are normalized by their maximum in the topic cluster, and the total is
+    the product of the scores divided by the sentence length
+    :param weights: optional dictionary of score name -> exponent of that score in the total, 1 if missing
+    :return: dictionary of topic id -> sentence -> sentence info of the scored sentences, which are
+    the sentences longer than 7 tokens that have an LDAscore
     '''
+    weights = weights or {}
     new_dict = {}
 
     for topic_id, sent in dic.items():
-        new_dict[topic_id] = dict()
-        tf_idf = []
-        concreteness = []
-        #lda = []
-        for key, info in sent.items():
-            tf_idf.append(info['tf_idf'])
-            concreteness.append(info['concreteness'])
-            #try:
-                #lda.append(info['LDAscore'])
-            #except KeyError:
-                #continue
-
-        m_tf_idf = max(tf_idf)
-        m_concrete = max(concreteness)
-        #m_lda = 1
+        keys = list(sent.keys())
+        # one row per sentence, one column per score, LDAscore is nan for sentences without one,
+        # the other scores must be there
+        scores = np.array([[sent[key].get(name, np.nan) if name == 'LDAscore' else sent[key][name]
+                            for name in SCORE_NAMES]
+                           for key in keys], dtype=float)
+        length = np.array([sent[key]['length'] for key in keys], dtype=float)
+
+        # normalize by the maxima over all sentences of the cluster:
+        long_sentences = length > 7
+        for name in NORMALIZED_SCORES:
+            column = SCORE_NAMES.index(name)
+            scores[long_sentences, column] = scores[long_sentences, column] / np.max(scores[:, column])
+
+        scored = long_sentences & ~np.isnan(scores[:, SCORE_NAMES.index('LDAscore')])
+        total = np.ones(len(keys))
+        for column, name in enumerate(SCORE_NAMES):
+            total = total * np.power(scores[:, column], weights.get(name, 1))
+        total = total / length
 
-        for key, info in sent.items():
-
-            if info['length'] > 7:
-                info['tf_idf'] = info['tf_idf'] / m_tf_idf
-                info['concreteness'] = info['concreteness'] / m_concrete
-                try:
-                    #info['LDAscore'] = info['LDAscore'] / m_lda
-                    info['total'] = (info['tf_idf'] * info['concreteness'] * info['LDAscore']) / info['length']
-                    sent_info = {k: v for k, v in info.items()}
-                    new_dict[topic_id][key] = sent_info
-
-                except KeyError:
-                    continue
+        new_dict[topic_id] = dict()
+        for row in np.flatnonzero(long_sentences):
+            info = sent[keys[row]]
+            for name in NORMALIZED_SCORES:
+                info[name] = float(scores[row, SCORE_NAMES.index(name)])
+            if scored[row]:
+                info['total'] = float(total[row])
+                new_dict[topic_id][keys[row]] = info
     return new_dict
 
 
-def select_sent(data, num_sentences):
+def get_group_sizes(groups, num_sentences):
+    '''
+    shares num_sentences between the LDA topic groups: every group gets num_sentences // len(groups)
+    sentences. If there are more groups than sentences, the sentences are handed out one at a time
+    to the groups that still have candidates, starting with the group with the best scoring sentence
+    :param groups: list of (sentence, total) of every LDA topic
+    :return: number of sentences to pick from every group
+    '''
+    per_group = num_sentences // len(groups)
+    if per_group >= 1:
+        return [per_group] * len(groups)
+
+    sizes = [0] * len(groups)
+    best = [max(score for _, score in group) if group else float('-inf') for group in groups]
+    order = sorted((i for i in range(len(groups)) if groups[i]), key=lambda i: best[i], reverse=True)
+    remaining = num_sentences
+    while remaining > 0 and any(sizes[i] < len(groups[i]) for i in order):
+        for group_id in order:
+            if remaining > 0 and sizes[group_id] < len(groups[group_id]):
+                sizes[group_id] += 1
+                remaining -= 1
+    return sizes
+
+
+def select_sent(data, num_sentences, num_topics=3):
+    '''
+    picks the num_sentences / num_topics best scoring sentences of every LDA topic, or with more
+    topics than sentences at most num_sentences in total (see get_group_sizes)
+    :param num_topics: number of LDA topics, i.e. lda_topic_id is in 0..num_topics - 1
+    :return: dictionary of topic id -> sentence -> sentence info, grouped by LDA topic
+    '''
     picked_sent = {}
 
     for topic_id, sent in data.items():
-        candidates = []
-        group_1 = []
-        group_2 = []
-        group_3 = []
+        groups = [[] for _ in range(num_topics)]
         for key, info in sent.items():
             try:
-                total = info['total']
-                if info['lda_topic_id'] == 0:
-                    group_1.append((key, total))
-                elif info['lda_topic_id'] == 1:
-                    group_2.append((key, total))
-                else:
-                    group_3.append((key, total))
-            #                     candidates.append((key, total))
+                groups[info['lda_topic_id']].append((key, info['total']))
             except KeyError:
                 continue
 
-        sorted_1 = sorted(group_1, key=lambda x: x[1], reverse=True)[:int(num_sentences / 3)]
-        sorted_2 = sorted(group_2, key=lambda x: x[1], reverse=True)[:int(num_sentences / 3)]
-        sorted_3 = sorted(group_3, key=lambda x: x[1], reverse=True)[:int(num_sentences / 3)]
-
-        sorted_sentences = sorted_1 + sorted_2 + sorted_3
+        sorted_sentences = []
+        for group, size in zip(groups, get_group_sizes(groups, num_sentences)):
+            sorted_sentences.extend(heapq.nlargest(size, group, key=lambda x: x[1]))
 
         picked_sent[topic_id] = dict()
         for sentence, score in sorted_sentences:
@@ -179,14 +326,18 @@ def select_sent(data, num_sentences):
     return picked_sent
 
 
-def sentence_selection_wrapper(input_data, selected_json_path, num_sentences=20, overwrite=False, random_state=1):
+def sentence_selection_wrapper(input_data, selected_json_path, num_sentences=20, overwrite=False, random_state=1,
+                               workers=1, model_cache_dir=None, num_topics=3, update=False):
+    if num_topics < 1:
+        raise ValueError("num_topics must be at least 1, got {}".format(num_topics))
     if os.path.exists(selected_json_path) and not overwrite:
         with open(selected_json_path) as infile:
             return json.load(infile)
 
-    new_dict = lda_analysis(input_data, random_state=random_state, num_topics=3)
+    new_dict = lda_analysis(input_data, random_state=random_state, num_topics=num_topics, workers=workers,
+                            model_cache_dir=model_cache_dir, update=update)
     update_and_normalize = update_scores(new_dict)
-    picked_sentences = select_sent(update_and_normalize, num_sentences)
+    picked_sentences = select_sent(update_and_normalize, num_sentences, num_topics)
     with open(selected_json_path, "w") as outfile:
         json.dump(picked_sentences, outfile, indent=2)
     return picked_sentences
@@ -0,0 +1,71 @@
+import json
+import hashlib
+import sqlite3
+
+
+class SentenceFeatureCache(object):
+    '''
+    Persistent store of sentence features, shared across splits and runs.
+    Sentences are keyed by a hash of their text, the spaCy model (name and version) and the
+    extracted features. Documents are keyed by a hash of their text and map to the texts of
+    their sentences, so that documents whose sentences are all cached can skip annotation.
+    Inputs: path of the sqlite database, model - name and version of the spaCy model,
+    features - the names of the extracted features, optional - flush_every, the number of new
+    sentences kept in memory before they are written
+    '''
+    def __init__(self, path, model, features, flush_every=10000):
+        self.namespace = json.dumps([model, sorted(features)])
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sentences (key TEXT PRIMARY KEY, features TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, sentences TEXT)")
+        self.connection.commit()
+        self.pending_sentences = {}
+        self.pending_documents = {}
+        self.flush_every = flush_every
+
+    def key(self, text):
+        return hashlib.sha1((self.namespace + "\n" + text).encode("utf-8")).hexdigest()
+
+    def get(self, sentence):
+        '''Returns the cached features of a sentence, None if it was not seen yet'''
+        key = self.key(sentence)
+        if key in self.pending_sentences:
+            return json.loads(self.pending_sentences[key])
+        row = self.connection.execute("SELECT features FROM sentences WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, sentence, features):
+        self.pending_sentences[self.key(sentence)] = json.dumps(features)
+        if len(self.pending_sentences) >= self.flush_every:
+            self.flush()
+
+    def get_document(self, document):
+        '''Returns the sentence texts of a document if all of them are cached, otherwise None'''
+        key = self.key(document)
+        if key in self.pending_documents:
+            sentences = json.loads(self.pending_documents[key])
+        else:
+            row = self.connection.execute("SELECT sentences FROM documents WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            sentences = json.loads(row[0])
+        if all(self.get(sentence) is not None for sentence in sentences):
+            return sentences
+        return None
+
+    def put_document(self, document, sentences):
+        self.pending_documents[self.key(document)] = json.dumps(sentences)
+
+    def flush(self):
+        '''Writes the pending entries to the database'''
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO sentences VALUES (?, ?)",
+                                        self.pending_sentences.items())
+            self.connection.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?)",
+                                        self.pending_documents.items())
+        self.pending_sentences = {}
+        self.pending_documents = {}
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -1,13 +1,19 @@
 import os
 import json
+from collections import OrderedDict
 import spacy
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from spacy.lang.en import English
 import en_core_web_sm
 from sklearn.feature_extraction.text import TfidfVectorizer 
 import tqdm 
+from .feature_cache import SentenceFeatureCache
 
 nlp = spacy.load("en_core_web_sm") # package
+# identifies the annotations in the sentence feature cache
+MODEL_VERSION = "{}_{}-{}/spacy-{}".format(nlp.meta["lang"], nlp.meta["name"], nlp.meta["version"], spacy.__version__)
 spacy_stopwords = spacy.lang.en.stop_words.STOP_WORDS
 
 '''
@@ -58,20 +64,25 @@ def get_namedentities(spacysentdoc):
             namedentities[ent.label_] = [ent.text]
     return namedentities
         
-def get_concreteness(spacysentdoc, df):
+def load_concreteness(concreteness_file):
+    '''Loads the http://crr.ugent.be/archives/1330 dataset once into a dictionary
+    Inputs: path to the tab separated concreteness file
+    Outputs: a dictionary with keys = words, values = their mean concreteness (Conc.M).
+    If a word is listed more than once, its first rating is kept
+    '''
+    df = pd.read_csv(concreteness_file, sep="\t", header=0)
+    df = df.drop_duplicates(subset="Word", keep="first")
+    return dict(zip(df["Word"], df["Conc.M"]))
+
+def get_concreteness(spacysentdoc, concreteness):
     '''given a list of strings (tokens of a sentence), returns the concreteness
     score for the sentence. The score is the sum of the score for tokens that can be 
     found in the http://crr.ugent.be/archives/1330 dataset. 
-    Inputs: spacysentdoc
+    Inputs: spacysentdoc, concreteness - the dictionary returned by load_concreteness
     Outputs: a tuple containing the function name and the result. result is an integer rounded to 3 dp 
     and converted to a string
     ''' 
-    c_score = 0
-    for token in [token.text for token in spacysentdoc]: 
-        try:
-            c_score += df[df["Word"] == token]["Conc.M"].values[0]
-        except:
-            pass
+    c_score = sum(concreteness.get(token.text, 0) for token in spacysentdoc)
     return round(c_score,5)
 
 def get_postags(spacysent):
@@ -96,52 +107,153 @@ def get_parsetags(spacysent):
 def get_noun_chunks(spacysent):
     return [chunk.text.lower() for chunk in spacysent.noun_chunks]
 
+'''
+Optional sentence features. doc_id, doc_index, topic_id, index, lemmas, length and total_sent
+are always extracted, tf_idf is always added from the lemmas
+'''
+FEATURE_EXTRACTORS = OrderedDict([
+    ("all_tokens", get_tokens),
+    ("postags", get_postags),
+    ("parsetags", get_parsetags),
+    ("namedent", get_namedentities),
+    ("noun_chunks", get_noun_chunks),
+    ("concreteness", get_concreteness),
+])
+ALL_FEATURES = tuple(FEATURE_EXTRACTORS.keys())
+# the features read by content selection (LDA.py) and summary generation
+SELECTION_FEATURES = ("concreteness",)
+# spaCy pipeline components that are only needed by some features, the others always run
+FEATURE_COMPONENTS = {"namedent": ("ner",)}
+
+def get_extractors(features, concreteness):
+    '''Returns an ordered dictionary with keys = feature names, values = functions of a sentence'''
+    unknown = [feature for feature in features if feature not in FEATURE_EXTRACTORS]
+    if unknown:
+        raise ValueError("unknown features {}, choose from {}".format(unknown, ALL_FEATURES))
+    extractors = OrderedDict()
+    for feature, extractor in FEATURE_EXTRACTORS.items():
+        if feature == "concreteness" and feature in features:
+            extractors[feature] = lambda sentence: get_concreteness(sentence, concreteness)
+        elif feature in features:
+            extractors[feature] = extractor
+    return extractors
+
+def get_disabled_components(features):
+    '''Returns the names of the optional spaCy pipeline components that none of the features need'''
+    optional = set(component for components in FEATURE_COMPONENTS.values() for component in components)
+    for feature in features:
+        optional.difference_update(FEATURE_COMPONENTS.get(feature, ()))
+    return [name for name in nlp.pipe_names if name in optional]
+
 # conversion to spacy doc
-def preprocess_data(data):
-    documents = {}
+def annotate(data, batch_size=100, n_process=1, features=ALL_FEATURES, cache=None):
+    '''
+    Streams the titles and documents of all topics through nlp.pipe
+    Inputs: data loaded by data_loader, optional - batch_size, the number of texts per batch,
+    n_process, the number of processes (n_process > 1 requires spaCy >= 2.2.2),
+    features, the pipeline components that none of them need are disabled,
+    cache, a SentenceFeatureCache - documents whose sentences are all cached are not annotated
+    and their sentences are yielded as strings
+    Outputs: yields (topic_id, (sentences, doc_id)) tuples in the order of data,
+    the title of each topic comes first as ([doc], 'TITLE')
+    '''
+    texts = []
     for topic_id in data.keys():
-        title = data[topic_id]['title']
-        docs = data[topic_id]['docs']
-        spacydocs = []
-        spacydocs.append(([nlp(title)], 'TITLE'))
-        for doc_id, doc in docs.items():
-            doc = nlp(doc)
-            spacydocs.append((get_sents_noquest(doc), doc_id))
-        documents[topic_id] = spacydocs
-        
+        texts.append((data[topic_id]['title'], (topic_id, 'TITLE')))
+        for doc_id, doc in data[topic_id]['docs'].items():
+            texts.append((doc, (topic_id, doc_id)))
+
+    cached = {}
+    if cache is not None:
+        for i, (text, _) in enumerate(texts):
+            sentences = cache.get_document(text)
+            if sentences is not None:
+                cached[i] = sentences
+
+    pipe_kwargs = {"batch_size": batch_size, "disable": get_disabled_components(features)}
+    if n_process != 1:
+        pipe_kwargs["n_process"] = n_process
+
+    annotated = nlp.pipe((entry for i, entry in enumerate(texts) if i not in cached), as_tuples=True, **pipe_kwargs)
+    for i, (text, (topic_id, doc_id)) in enumerate(tqdm.tqdm(texts, desc="annotating")):
+        if i in cached:
+            yield topic_id, (cached[i], doc_id)
+            continue
+
+        doc, _ = next(annotated)
+        if doc_id == 'TITLE':
+            sentences = [doc]
+        else:
+            sentences = get_sents_noquest(doc)
+        if cache is not None:
+            cache.put_document(text, [str(sentence) for sentence in sentences])
+        yield topic_id, (sentences, doc_id)
+
+def preprocess_data(data, batch_size=100, n_process=1, features=ALL_FEATURES, cache=None):
+    '''
+    Annotates the titles and documents of all topics
+    Outputs: a dictionary with keys = topic ids, values = a list of (sentences, doc_id) tuples,
+    starting with the title
+    '''
+    documents = {topic_id: [] for topic_id in data.keys()}
+    annotated = annotate(data, batch_size=batch_size, n_process=n_process, features=features, cache=cache)
+    for topic_id, listwithid in annotated:
+        documents[topic_id].append(listwithid)
     return documents
 
-def process_document(listwithid, doc_index, topic_id, sentences, concrete_df):
+def extract_features(sentence, extractors):
+    features = OrderedDict()
+    # lemmas for valid words (not stop, only alphabetic)
+    features["lemmas"] = get_lemmas(sentence)
+    # all tokens
+    features["length"] = len(tokens_per_sentence(sentence))
+    for feature, extractor in extractors.items():
+        features[feature] = extractor(sentence)
+    return features
+
+
+def process_document(listwithid, doc_index, topic_id, sentences, extractors, cache=None):
     spacydoc = listwithid[0]
     
     # spacydoc is a list of noninterrogative spacy preprocessed sentences
     total_sents = len(spacydoc) # total number of non-interrogative sentences
     for index, sentence in enumerate(spacydoc):
-        sentence_info = {"doc_id": listwithid[1], "doc_index": doc_index, "topic_id": topic_id, "index": index, "lemmas": list(), "length": 0, "total_sent": total_sents,
-                       "all_tokens": list(), "postags": list(),"parsetags": list(), "namedent": dict(), "noun_chunks": list(), "concreteness": 0.0 }
-
-        # all tokens
-        tokens = tokens_per_sentence(sentence)
-        sentence_info["length"] = len(tokens)
-        # lemmas for valid words (not stop, only alphabetic)
-        sentence_info["lemmas"] = get_lemmas(sentence)
-        sentence_info["postags"] = get_postags(sentence)
-        sentence_info["parsetags"] = get_parsetags(sentence)
-        sentence_info["namedent"] = get_namedentities(sentence)
-        sentence_info["concreteness"] = get_concreteness(sentence, concrete_df)
-        sentence_info['noun_chunks'] = get_noun_chunks(sentence)
-        sentence_info['all_tokens'] = get_tokens(sentence)
-        sentences[str(sentence)] = sentence_info
+        sentence_text = str(sentence)
+        features = cache.get(sentence_text) if cache is not None else None
+        if features is None:
+            features = extract_features(sentence, extractors)
+            if cache is not None:
+                cache.put(sentence_text, features)
+
+        sentence_info = {"doc_id": listwithid[1], "doc_index": doc_index, "topic_id": topic_id, "index": index, "lemmas": features["lemmas"], "length": features["length"], "total_sent": total_sents}
+        for feature in extractors:
+            sentence_info[feature] = features[feature]
+        sentences[sentence_text] = sentence_info
     return sentences
 
 
-def process_documents_by_topic(documents, concrete_df):
+def process_documents_by_topic(documents, extractors, cache=None):
     sentences_info = dict()
     for topic_id in documents.keys():
         sentences_info[topic_id] = dict()
         docs = documents[topic_id]
         for i, doc in tqdm.tqdm(enumerate(docs)):
-            process_document(doc, i, topic_id, sentences_info[topic_id], concrete_df)
+            process_document(doc, i, topic_id, sentences_info[topic_id], extractors, cache)
+    return sentences_info
+
+
+def process_documents_streaming(data, extractors, batch_size=100, n_process=1, cache=None):
+    '''
+    Same output as process_documents_by_topic(preprocess_data(data), extractors), but the
+    features of each document are extracted as soon as it is annotated, so its spaCy doc
+    can be released right away instead of keeping every doc of the split in memory
+    '''
+    sentences_info = {topic_id: dict() for topic_id in data.keys()}
+    doc_indices = {topic_id: 0 for topic_id in data.keys()}
+    annotated = annotate(data, batch_size=batch_size, n_process=n_process, features=extractors.keys(), cache=cache)
+    for topic_id, listwithid in annotated:
+        process_document(listwithid, doc_indices[topic_id], topic_id, sentences_info[topic_id], extractors, cache)
+        doc_indices[topic_id] += 1
     return sentences_info
 
 
@@ -160,47 +272,108 @@ def tfidf_preprocessing(grand_dict):
         all_docs.append(string_doc)
     return all_docs, topic_ids
 
-def get_sentence_tfidfs(lemmas, topic_id, tfidf_df):
-    total = 0
-    for lemma in lemmas:
-        try:
-            score = tfidf_df.loc[lemma, topic_id]
-        except KeyError:
-            score = 0
-        total += score    
-    return total
-
-def construct_tfidf_dataframe(lemmatized, tfidf_vectorizer):
+def get_sentence_tfidfs(sentence_lemmas, topic_tfidf, vocabulary):
+    '''Scores all the sentences of a topic at once
+    Inputs: a list with the lemmas of each sentence, the topic's row of the tf-idf matrix,
+    the vocabulary of the vectorizer (lemma -> column)
+    Outputs: an array with the sum of the tf-idf scores of each sentence's lemmas,
+    lemmas that are not in the vocabulary score 0
+    '''
+    rows = []
+    columns = []
+    for row, lemmas in enumerate(sentence_lemmas):
+        for lemma in lemmas:
+            column = vocabulary.get(lemma)
+            if column is not None:
+                rows.append(row)
+                columns.append(column)
+    # sentence-by-vocabulary count matrix, repeated lemmas are summed
+    counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(sentence_lemmas), len(vocabulary)))
+    return np.asarray(counts.dot(topic_tfidf.T).todense()).ravel()
+
+def construct_tfidf_matrix(lemmatized, tfidf_vectorizer):
+    '''Fits tf-idf on one document per topic (all of its lemmas)
+    Outputs: the sparse topic-by-vocabulary tf-idf matrix and the topic id of each row
+    '''
     preprocessed, ids = tfidf_preprocessing(lemmatized)
-    vectors=tfidf_vectorizer.fit_transform(preprocessed)
-    dense = vectors.todense()
-    tfidf_df = pd.DataFrame(dense, columns=tfidf_vectorizer.get_feature_names(), index=ids).T
-    return tfidf_df
-
-def update_with_tfidf(info_by_topic, tfidf_df):
-    for topic, info_by_sent in info_by_topic.items():
-        for sentence, sentence_info in info_by_sent.items():
-            lemmas = sentence_info['lemmas']
-            tfidf = get_sentence_tfidfs(lemmas, topic, tfidf_df)
-            sentence_info.update({"tf_idf" : tfidf})
+    vectors = tfidf_vectorizer.fit_transform(preprocessed)
+    return vectors.tocsr(), ids
+
+def update_with_tfidf(info_by_topic, tfidf_matrix, topic_ids, vocabulary):
+    for row, topic in enumerate(topic_ids):
+        info_by_sent = info_by_topic[topic]
+        sentence_lemmas = [sentence_info['lemmas'] for sentence_info in info_by_sent.values()]
+        tfidfs = get_sentence_tfidfs(sentence_lemmas, tfidf_matrix[row], vocabulary)
+        for sentence_info, tfidf in zip(info_by_sent.values(), tfidfs):
+            sentence_info.update({"tf_idf" : float(tfidf)})
         
     return info_by_topic
 
 
-def preprocess(data, preprocessed_json_path, overwrite=False):
+def write_preprocessed(info_by_topic, preprocessed_json_path):
+    '''
+    Writes the sentence features topic by topic to a temporary file, which replaces
+    preprocessed_json_path once it is complete, so an interrupted run never leaves
+    a truncated cache behind
+    '''
+    tmp_path = preprocessed_json_path + ".tmp"
+    with open(tmp_path, "w") as outfile:
+        outfile.write("{")
+        for i, (topic_id, info_by_sent) in enumerate(info_by_topic.items()):
+            outfile.write(",\n" if i else "\n")
+            outfile.write(json.dumps(topic_id) + ": ")
+            json.dump(info_by_sent, outfile)
+        outfile.write("\n}\n")
+    os.replace(tmp_path, preprocessed_json_path)
+
+
+def has_features(info_by_topic, features):
+    '''Checks that the sentences of a cached output have all the requested features'''
+    for info_by_sent in info_by_topic.values():
+        for sentence_info in info_by_sent.values():
+            return all(feature in sentence_info for feature in features)
+    return True
+
+
+def preprocess(data, preprocessed_json_path, overwrite=False, batch_size=100, n_process=1, stream=False,
+               features=ALL_FEATURES, cache_path=None):
+    '''
+    Inputs: data loaded by data_loader, path of the cached output, optional - overwrite the cache,
+    nlp.pipe batch_size and n_process, stream - extract features while annotating instead of
+    annotating the whole split first (see process_documents_streaming), features - the optional
+    features to extract and write (see FEATURE_EXTRACTORS), cache_path - sqlite database of the
+    SentenceFeatureCache, only sentences that are not in it are annotated. SELECTION_FEATURES are
+    always extracted, since the later stages read them
+    Outputs: a dictionary with keys = topic ids, values = a dictionary of sentence features
+    '''
+    features = tuple(features) + tuple(feature for feature in SELECTION_FEATURES if feature not in features)
     if os.path.exists(preprocessed_json_path) and not overwrite:
         with open(preprocessed_json_path) as infile:
-            return json.load(infile)
+            cached = json.load(infile)
+        if has_features(cached, features):
+            return cached
+        print("{} is missing some of the features {}, preprocessing again".format(preprocessed_json_path, features))
 
     concreteness_file = os.path.join("working_files", "concreteness.txt")
-    concrete_df = pd.read_csv(concreteness_file, sep="\t", header=0)
+    concreteness = load_concreteness(concreteness_file) if "concreteness" in features else None
+    extractors = get_extractors(features, concreteness)
+    cache = None
+    if cache_path is not None:
+        cache = SentenceFeatureCache(cache_path, MODEL_VERSION, extractors.keys())
 
-    documents = preprocess_data(data)
-    sent_info = process_documents_by_topic(documents, concrete_df)
+    if stream:
+        sent_info = process_documents_streaming(data, extractors, batch_size=batch_size, n_process=n_process,
+                                                cache=cache)
+    else:
+        documents = preprocess_data(data, batch_size=batch_size, n_process=n_process, features=extractors.keys(),
+                                    cache=cache)
+        sent_info = process_documents_by_topic(documents, extractors, cache)
+    if cache is not None:
+        cache.close()
+    # tf-idf is the only step that needs the lemmas of all topics
     tfidf_vectorizer=TfidfVectorizer(use_idf=True)
-    tf_idf_df = construct_tfidf_dataframe(sent_info, tfidf_vectorizer)
-    updated_dict = update_with_tfidf(sent_info, tf_idf_df)
+    tfidf_matrix, topic_ids = construct_tfidf_matrix(sent_info, tfidf_vectorizer)
+    updated_dict = update_with_tfidf(sent_info, tfidf_matrix, topic_ids, tfidf_vectorizer.vocabulary_)
 
-    with open(preprocessed_json_path, "w") as outfile:
-        json.dump(updated_dict, outfile, indent=2)
-    return updated_dict
\ No newline at end of file
+    write_preprocessed(updated_dict, preprocessed_json_path)
+    return updated_dict
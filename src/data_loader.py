@@ -1,11 +1,22 @@
 import os
+import io
+import re
 import argparse
-from bs4 import BeautifulSoup
+from lxml import etree
 import json
 import gzip
-from collections import defaultdict
+import tempfile
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from tqdm import tqdm, trange
+from tqdm import tqdm
+
+
+DOC_PATTERN = re.compile(rb"<DOC[\s>].*?</DOC>", re.DOTALL | re.IGNORECASE)
+DOC_ID_PATTERN = re.compile(rb'<DOC\s+id\s*=\s*"([^"]+)"', re.IGNORECASE)  # ACQUAINT-2
+DOCNO_PATTERN = re.compile(rb"<DOCNO>\s*(\S+)\s*</DOCNO>", re.IGNORECASE)  # ACQUAINT
+
+Document = namedtuple("Document", ["doc_id", "headline", "dateline", "paragraphs", "category"])
 
 
 def get_path_from_docid(doc_id, split, data_store):
@@ -37,96 +48,320 @@ def get_path_from_docid(doc_id, split, data_store):
         return path
 
 
-def process_acquaint1(path, doc_id):
-    print("processing {} in process_acquaint1".format(path))
-    myfile = open(path, 'r')
-    myfile_data = myfile.read().replace("\n", ' ').strip()
-    document_string = ""
-    doc_soup = BeautifulSoup(myfile_data, 'lxml')
-    results = doc_soup.find_all("docno")
-    for result in results:
-        if result.contents[0].strip() == doc_id:
-            docno = result
-            break
+def open_corpus(path):
+    """Opens a corpus file for binary reading, decompressing .gz files on the fly."""
+    if path.endswith(".gz"):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
 
-    doc = docno.parent
 
-    if doc.find("headline"):
-        headline = doc.find("headline").contents[0].strip()
-    else:
-        headline = ""
-    if doc.find("date_time").contents[0].strip():
-        date_time = doc.find("date_time").contents[0].strip()
-    else:
-        date_time = ""
+def index_corpus_data(file_data):
+    """
+    Records where each document of a corpus file starts and ends.
+    Args:
+        file_data (bytes): contents of an ACQUAINT, ACQUAINT-2 or (decompressed) evaltest file
+    Returns:
+        {"doc_id": [start, end]} byte offsets of each <DOC> element
+    """
+    offsets = {}
+    for match in DOC_PATTERN.finditer(file_data):
+        doc = match.group(0)
+        id_match = DOC_ID_PATTERN.match(doc) or DOCNO_PATTERN.search(doc)
+        if id_match is not None:
+            offsets[id_match.group(1).decode()] = [match.start(), match.end()]
+    return offsets
+
+
+def load_doc_index(index_path):
+    """
+    Returns:
+        {"path": {"size": size, "mtime": mtime, "offsets": {"doc_id": [start, end]}}},
+        empty if index_path does not exist yet or can not be read
+    """
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as infile:
+        try:
+            return json.load(infile)
+        except ValueError:
+            print("{} is corrupt, corpus files will be indexed again".format(index_path))
+            return {}
+
+
+def save_doc_index(doc_index, index_path):
+    write_json_atomic(doc_index, index_path)
 
-    if doc.find("category"):
-        category = doc.find("category").contents[0].strip()
-    else:
-        category = ""
-    text = doc.find("text").find_all("p")
-    document_string += headline + ". " + date_time + ". " + category + ". "
 
-    for line in text:
-        document_string += line.contents[0].strip() + " "
+def get_file_offsets(doc_index, path):
+    """
+    Returns the offsets of the documents in a corpus file, or None if the
+    file is not indexed or changed (size or modification time) since it was.
+    """
+    entry = doc_index.get(path)
+    if entry is None or "offsets" not in entry:
+        return None
+    stat = os.stat(path)
+    if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+        return None
+    return entry["offsets"]
+
+
+def make_index_entry(path, offsets):
+    """Returns the doc_index entry of a corpus file, see load_doc_index"""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "offsets": offsets}
+
+
+def get_corpus(doc_id, split):
+    """Returns the config.json key of the corpus that holds doc_id."""
+    if "_" in doc_id and split != 'evaltest':  # Then the document is in the newer ACQUAINT-2
+        return "acquaint-2"
+    elif "_" in doc_id and split == 'evaltest':
+        return "evaltest-data"
+    else:  # Then the document is in the older ACQUAINT-1
+        return "acquaint"
+
+
+def plan_fetches(doc_ids, split, data_store):
+    """
+    Groups documents by the corpus file they are stored in.
+    Args:
+        doc_ids (iterable): ids of the documents to fetch
+    Returns:
+        {"path": [doc_id ... doc_id]} in order of first appearance
+    """
+    plan = OrderedDict()
+    for doc_id in doc_ids:
+        path = get_path_from_docid(doc_id, split, data_store)
+        if doc_id not in plan.setdefault(path, []):
+            plan[path].append(doc_id)
+    return plan
+
+
+def open_corpus_file(path, doc_ids, offsets=None):
+    """
+    Returns a binary stream holding only the byte ranges of doc_ids, and the
+    offsets of every document in the file.
+    If the file is not indexed yet (offsets is None), it is read (and for
+    evaltest, decompressed) once to build its offsets. Otherwise only the
+    requested ranges are read: plain files are seeked directly, and gzipped
+    files are inflated up to the end of the last requested document.
+    """
+    if offsets is None:
+        with open_corpus(path) as infile:
+            file_data = infile.read()
+        offsets = index_corpus_data(file_data)
+        if not all(doc_id in offsets for doc_id in doc_ids):
+            return io.BytesIO(file_data), offsets
+        ranges = sorted(offsets[doc_id] for doc_id in doc_ids)
+        return io.BytesIO(b"\n".join(file_data[start:end] for start, end in ranges)), offsets
+
+    if not all(doc_id in offsets for doc_id in doc_ids):
+        return open_corpus(path), offsets
+
+    slices = []
+    with open_corpus(path) as infile:
+        for start, end in sorted(offsets[doc_id] for doc_id in doc_ids):
+            infile.seek(start)
+            slices.append(infile.read(end - start))
+    return io.BytesIO(b"\n".join(slices)), offsets
+
+
+def clean_text(element):
+    """Text of an element up to its first child, on a single line."""
+    if element is None or element.text is None:
+        return ""
+    return element.text.replace("\n", ' ').strip()
+
+
+def iter_documents(source):
+    """
+    Streams the <DOC> elements of a corpus file with lxml's HTML parser
+    (the same parser BeautifulSoup used) and clears each one once it is read.
+    Args:
+        source: binary file object of an ACQUAINT, ACQUAINT-2 or evaltest file
+    Yields:
+        Document(doc_id, headline, dateline, paragraphs, category) records. For
+        ACQUAINT documents dateline is the DATE_TIME field; category is only set
+        for ACQUAINT documents.
+    """
+    for _, doc in etree.iterparse(source, events=("end",), tag="doc", html=True,
+                                  encoding="utf-8", huge_tree=True):
+        doc_id = doc.get("id")
+        if doc_id is None:  # ACQUAINT documents store their id in <DOCNO>
+            doc_id = clean_text(doc.find(".//docno"))
+        dateline = doc.find(".//dateline")
+        if dateline is None:
+            dateline = doc.find(".//date_time")
+        text = doc.find(".//text")
+        paragraphs = [] if text is None else [clean_text(p) for p in text.iter("p")]
+        yield Document(
+            doc_id=doc_id,
+            headline=clean_text(doc.find(".//headline")),
+            dateline=clean_text(dateline),
+            paragraphs=paragraphs,
+            category=clean_text(doc.find(".//category")),
+        )
+
+        doc.clear()
+        while doc.getprevious() is not None:
+            del doc.getparent()[0]
+
+
+def format_acquaint1(document):
+    document_string = document.headline + ". " + document.dateline + ". " + document.category + ". "
+    for line in document.paragraphs:
+        document_string += line + " "
     return document_string
 
 
-def process_acquaint2(path, doc_id):
-    print("processing {} in process_acquaint2".format(path))
-    myfile = open(path, 'r')
-    myfile_data = myfile.read().replace("\n", ' ').strip()
+def format_acquaint2(document):
+    """Also used for the evaltest corpus, which has the ACQUAINT-2 format."""
     document_string = ""
-    doc_soup = BeautifulSoup(myfile_data, 'lxml')
-
-    headline = ""
-    dateline = ""
-    if doc_soup.find(id=str(doc_id)).find("headline"):
-        headline = doc_soup.find(id=str(doc_id)).find("headline").contents[0].strip()
-    if doc_soup.find(id=str(doc_id)).find("dateline"):
-        dateline = doc_soup.find(id=str(doc_id)).find("dateline").contents[0].strip()
-    text = doc_soup.find(id=str(doc_id)).find("text").find_all("p")
-
-    # document_string += headline + ". " + dateline + ". "
-    if headline:
-        document_string += headline + ". "
-    if dateline:
-        document_string += dateline + ". "
-    for line in text:
-        document_string += line.contents[0].strip() + " "
+    if document.headline:
+        document_string += document.headline + ". "
+    if document.dateline:
+        document_string += document.dateline + ". "
+    for line in document.paragraphs:
+        document_string += line + " "
     return document_string
 
 
-def process_evaltest(path, doc_id):
-    print("processing {} in process_evaltest".format(path))
-    myfile = gzip.open(path, 'rb')
-    myfile_data = myfile.read().decode().replace("\n", ' ').strip()
-    document_string = ""
-    doc_soup = BeautifulSoup(myfile_data, 'lxml')
-
-    headline = ""
-    dateline = ""
-    if doc_soup.find(id=str(doc_id)).find("headline"):
-        headline = doc_soup.find(id=str(doc_id)).find("headline").contents[0].strip()
-    if doc_soup.find(id=str(doc_id)).find("dateline"):
-        dateline = doc_soup.find(id=str(doc_id)).find("dateline").contents[0].strip()
-    text = doc_soup.find(id=str(doc_id)).find("text").find_all("p")
-
-    if headline:
-        document_string += headline + ". "
-    if dateline:
-        document_string += dateline + ". "
-    for line in text:
-        document_string += line.contents[0].strip() + " "
+FORMATTERS = {
+    "acquaint": format_acquaint1,
+    "acquaint-2": format_acquaint2,
+    "evaltest-data": format_acquaint2,
+}
 
-    return document_string
+
+def process_file(path, doc_ids, corpus, offsets=None):
+    """
+    Reads a corpus file once and extracts all the requested documents from it.
+    Args:
+        offsets (dict): index entry of the file, None if it is not indexed yet
+    Returns:
+        ({"doc_id": text}, offsets of the file)
+    """
+    print("processing {} ({} documents)".format(path, len(doc_ids)))
+    format_document = FORMATTERS[corpus]
+    documents = {}
+    source, offsets = open_corpus_file(path, doc_ids, offsets)
+    with source:
+        for document in iter_documents(source):
+            if document.doc_id in doc_ids and document.doc_id not in documents:
+                documents[document.doc_id] = format_document(document)
+                if len(documents) == len(doc_ids):
+                    break
+    return {doc_id: documents[doc_id] for doc_id in doc_ids}, offsets
+
+
+def process_acquaint1(path, doc_id, offsets=None):
+    return process_file(path, [doc_id], "acquaint", offsets)[0][doc_id]
+
+
+def process_acquaint2(path, doc_id, offsets=None):
+    return process_file(path, [doc_id], "acquaint-2", offsets)[0][doc_id]
+
+
+def process_evaltest(path, doc_id, offsets=None):
+    return process_file(path, [doc_id], "evaltest-data", offsets)[0][doc_id]
+
+
+def fetch_documents(doc_ids, split, data_store, doc_index, workers=1):
+    """
+    Fetches documents file by file, so each corpus file is read (and
+    decompressed) at most once no matter how many of the requested documents
+    it holds. Files that were not indexed yet, or changed since they were,
+    are (re)indexed in doc_index.
+    Args:
+        workers (int): number of processes to parse corpus files with
+    Returns:
+        {"doc_id": text}
+    """
+    plan = plan_fetches(doc_ids, split, data_store)
+    paths = list(plan.keys())
+    tasks = [(path, plan[path], get_corpus(plan[path][0], split), get_file_offsets(doc_index, path))
+             for path in paths]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map returns results in the order of the plan, whatever order the workers finish in
+            results = list(tqdm(executor.map(process_file, *zip(*tasks)), total=len(tasks), desc="corpus file"))
+    else:
+        results = [process_file(*task) for task in tqdm(tasks, desc="corpus file")]
+
+    documents = {}
+    for path, task, (file_documents, offsets) in zip(paths, tasks, results):
+        if task[3] is None:
+            doc_index[path] = make_index_entry(path, offsets)
+        documents.update(file_documents)
+    return documents
+
+
+def get_docset_topic_id(topic_id, docset):
+    """
+    Returns the key of a docset in the loaded data: the topic id for docset A,
+    and topic_id-<docset> (e.g. D0901A-B) for the update docsets.
+    """
+    if docset == "A":
+        return topic_id
+    return "{}-{}".format(topic_id, docset)
 
 
-def read_data(xml_filename, split, data_store, test=False, overwrite=False):
+def iter_topics(xml_filename, docsets=("A",)):
     """
+    Streams the <topic> elements of a TAC documents specification.
+    Args:
+        docsets (tuple): docsets of every topic to yield, in this order. Topics
+            without one of them, e.g. without an update docset B, skip it.
+    Yields:
+        (topic_id, title, narrative, doc_ids) for every docset of a topic, where
+        topic_id is named by get_docset_topic_id, doc_ids are the documents of the
+        docset and narrative is "" when the topic has none
+    """
+    for _, topic in etree.iterparse(xml_filename, events=("end",), tag="topic", html=True):
+        topic_id = topic.get("id")
+        title = clean_text(topic.find(".//title")).replace("\t", '').strip()
+        narrative = clean_text(topic.find(".//narrative")).replace("\t", '').strip()
+        for docset_name in docsets:
+            docset = topic.find(".//*[@id='{}-{}']".format(topic_id, docset_name))
+            if docset is None and docset_name != "A":
+                continue
+            doc_ids = [doc.get("id") for doc in docset.iter("doc")]
+            yield get_docset_topic_id(topic_id, docset_name), title, narrative, doc_ids
+
+        topic.clear()
+        while topic.getprevious() is not None:
+            del topic.getparent()[0]
+
+
+def write_json_atomic(data, json_path):
+    """Writes data to a temporary file next to json_path and moves it into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(json_path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as json_file:
+            json.dump(data, json_file, indent=2)
+        os.replace(tmp_path, json_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_data(xml_filename, split, data_store, test=False, overwrite=False, workers=1, docsets=("A",)):
+    """
+    The json cache in working_dir is checked topic by topic and document by
+    document: only documents that are not cached yet are fetched, and they are
+    merged into the cache. Documents are fetched grouped by corpus file (see
+    fetch_documents). Corpus files are indexed the first time they are read and
+    the index is kept in working_dir, so later runs only read the byte ranges
+    of the requested documents. With test, an existing <topics>.json.small
+    cache limits the topics to the ones in it and is never extended.
     Args:
         xml_filename (str): TAC documents specification
         data_store (dict): loaded config.json
+        overwrite (bool): ignore the cache and fetch every document again
+        workers (int): number of processes used to fetch documents
+        docsets (tuple): docsets to load, ("A", "B") for update summarization
     Returns:
         {"topic_id": {
             "title": title,
@@ -136,62 +371,60 @@ def read_data(xml_filename, split, data_store, test=False, overwrite=False):
     json_path = os.path.join(data_store["working_dir"], os.path.basename(xml_filename)[:-4] + ".json")
     if test:
         json_path += ".small"
+    cache = {}
     if os.path.exists(json_path) and not overwrite:
         with open(json_path) as infile:
-            return json.load(infile)
-
-    with open(xml_filename, 'r') as myfile:
-        myfile_data = myfile.read().replace('\n', ' ')
+            cache = json.load(infile)
+    cached_documents = {doc_id: text for topic in cache.values() for doc_id, text in topic["docs"].items()}
+
+    # an existing test cache is a hand-picked subset of the topics, which is returned as it is
+    test_subset = test and bool(cache)
+    topics = OrderedDict()
+    for topic_id, title, narrative, doc_ids in iter_topics(xml_filename, docsets):
+        if test_subset and topic_id not in cache:
+            continue
+        if topic_id not in topics:
+            topics[topic_id] = (title, narrative, doc_ids)
+    missing_doc_ids = [doc_id for _, _, doc_ids in topics.values() for doc_id in doc_ids
+                       if doc_id not in cached_documents]
+
+    documents = dict(cached_documents)
+    if missing_doc_ids:
+        print("fetching {} documents that are not in {}".format(len(missing_doc_ids), json_path))
+        index_path = os.path.join(data_store["working_dir"], "doc_index.json")
+        doc_index = load_doc_index(index_path)
+        indexed = dict(doc_index)
+        documents.update(fetch_documents(missing_doc_ids, split, data_store, doc_index, workers=workers))
+        if doc_index != indexed:
+            save_doc_index(doc_index, index_path)
 
-    soup = BeautifulSoup(myfile_data, 'lxml')
-
-    names = soup.find_all('topic')
-    titles = [element.contents[0].replace("\t", '').strip() for element in soup.find_all("title")]
+    data = {}
+    for topic_id, (title, narrative, doc_ids) in topics.items():
+        data[topic_id] = dict()
+        data[topic_id]["title"] = title
 
-    if split != 'evaltest':
-        narrative = [element.contents[0].replace("\t", '').strip() for element in soup.find_all("narrative")]
+        if split != "devtest" and split != 'evaltest':
+            data[topic_id]["narrative"] = narrative
 
-    data = {}
-    for i in trange(len(names), desc="topic"):
-        name = names[i]
-        topic_id = name.get("id")
-        if topic_id not in data:
-            data[topic_id] = dict()
-            data[topic_id]["title"] = titles[i]
-
-            if split != "devtest" and split != 'evaltest':
-                data[topic_id]["narrative"] = narrative[i].replace("\t", '')
-
-            data[topic_id]["docs"] = {}
-            docs = soup.find(id=topic_id + "-A").children
-            for doc in docs:
-                if str(type(doc)) == "<class 'bs4.element.Tag'>":
-                    doc_id = doc["id"]
-                    path = get_path_from_docid(doc_id, split, data_store)
-                    if "_" in doc_id and split != 'evaltest':  # Then the document is in the newer ACQUAINT-2
-                        document = process_acquaint2(path, doc_id)
-                    if "_" in doc_id and split == 'evaltest':
-                        document = process_evaltest(path, doc_id)
-                    else:  # Then the document is in the older ACQUAINT-1
-                        document = process_acquaint1(path, doc_id)
-
-                    data[topic_id]["docs"][doc_id] = document
+        data[topic_id]["docs"] = {doc_id: documents[doc_id] for doc_id in doc_ids}
 
     print("finished fetching all the data")
-    if not os.path.exists(json_path):
-        with open(json_path, 'w+') as json_file:
-            print("writing to {}".format(json_path))
-            json.dump(data, json_file, indent=2)
-            print("finished writing to {}".format(json_path))
+    if not test_subset and (missing_doc_ids or any(topic_id not in cache for topic_id in data)):
+        cache.update(data)
+        print("writing to {}".format(json_path))
+        write_json_atomic(cache, json_path)
+        print("finished writing to {}".format(json_path))
     return data
 
 
-def load_data(data_type, data_store, split, test=False, overwrite=False):
+def load_data(data_type, data_store, split, test=False, overwrite=False, workers=1, docsets=("A",)):
     """
     Args:
         data_type (str): must be in DATA_TYPES and in config.json
         split (str): training, devtest, or evaltest
         year (int): data from the year of the task
+        workers (int): number of processes used to fetch documents
+        docsets (tuple): docsets to load, ("A", "B") for update summarization
     """
     if split == "devtest":
         year = 2010
@@ -206,7 +439,8 @@ def load_data(data_type, data_store, split, test=False, overwrite=False):
     files = [f for f in os.listdir(dirname) if f.endswith(".xml")]
     assert len(files) == 1
     xml_filename = os.path.join(dirname, files[0])
-    data = read_data(xml_filename, split, data_store, test=test, overwrite=overwrite)
+    data = read_data(xml_filename, split, data_store, test=test, overwrite=overwrite, workers=workers,
+                     docsets=docsets)
     return data, xml_filename
 
 
@@ -215,6 +449,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="config.json")
     parser.add_argument("--split", type=str, default="training", choices=["devtest", "evaltest", "training"])
+    parser.add_argument("--load_workers", type=int, default=1, help="number of processes used to fetch documents")
     args = parser.parse_args()
 
     with open(args.config) as infile:
@@ -225,4 +460,4 @@ if __name__ == "__main__":
     if not os.path.exists(data_store["working_dir"]):
         os.makedirs(data_store["working_dir"])
 
-    input_data = load_data("input_data", data_store, split)
+    input_data = load_data("input_data", data_store, split, workers=args.load_workers)
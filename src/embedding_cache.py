@@ -0,0 +1,84 @@
+import json
+import time
+import hashlib
+import sqlite3
+import numpy as np
+
+
+class EmbeddingCache(object):
+    '''
+    Persistent store of sentence embeddings, shared across splits, deliverables and runs.
+    Embeddings are keyed by a hash of the sentence text and the namespace, which names the model,
+    its revision and the pooling, so embeddings of different models never mix.
+    The least recently used embeddings are evicted once there are more than max_entries.
+    Several processes can read and write the cache at the same time: the database uses a
+    write-ahead log and writers wait for each other up to timeout seconds.
+    Inputs: path of the sqlite database, namespace - string identifying the model and pooling,
+    optional - max_entries, timeout
+    '''
+    def __init__(self, path, namespace, max_entries=500000, timeout=60):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA busy_timeout = {}".format(int(timeout * 1000)))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                                "(key TEXT PRIMARY KEY, vector BLOB, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+
+    def key(self, sentence):
+        return hashlib.sha1((self.namespace + "\n" + sentence).encode("utf-8")).hexdigest()
+
+    def get_many(self, sentences, chunk_size=500):
+        '''Returns a dictionary of sentence -> float32 embedding of the sentences that are cached'''
+        keys = {self.key(sentence): sentence for sentence in sentences}
+        found = {}
+        key_list = list(keys.keys())
+        for start in range(0, len(key_list), chunk_size):
+            chunk = key_list[start:start + chunk_size]
+            rows = self.connection.execute(
+                "SELECT key, vector FROM embeddings WHERE key IN ({})".format(", ".join("?" * len(chunk))), chunk)
+            for key, vector in rows:
+                found[keys[key]] = np.frombuffer(vector, dtype=np.float32)
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                            ((now, self.key(sentence)) for sentence in found))
+        return found
+
+    def put_many(self, sentences, matrix):
+        '''Stores the embeddings in the rows of matrix and evicts the least recently used ones'''
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                ((self.key(sentence), np.asarray(embed, dtype=np.float32).tobytes(), now)
+                 for sentence, embed in zip(sentences, matrix)))
+            self.evict()
+
+    def evict(self):
+        num_entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.connection.execute("DELETE FROM embeddings WHERE key IN "
+                                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                                    (num_entries - self.max_entries,))
+
+    def close(self):
+        self.connection.close()
+
+
+def get_namespace(model_name, pooling, mode=None, revision=None):
+    '''
+    Returns the namespace of the embeddings of a model with a pooling, see EmbeddingCache.
+    mode names inference settings that change the embeddings, e.g. quantization, None for the defaults.
+    revision identifies the version of the model and its tokenizer, so embeddings of a changed model
+    with the same name are not reused
+    '''
+    namespace = [model_name, pooling]
+    if mode is not None:
+        namespace.append(mode)
+    if revision is not None:
+        namespace.append({"revision": revision})
+    return json.dumps(namespace)
@@ -70,6 +70,8 @@ def write_eval_config(args, data_store, overwrite=True):
     # print("args.split: {}".format(args.split))
 
     outf = "rouge_run_{}_{}.xml".format(args.deliverable, args.split)
+    # update summarization is also evaluated against the model summaries of docset B
+    docsets = ['-A', '-B'] if args.update else ['-A']
 
     if args.split == 'training':
         outputs_path = data_store["training_outdir"]
@@ -78,14 +80,16 @@ def write_eval_config(args, data_store, overwrite=True):
         output_files = [f for f in os.listdir(outputs_path) if isfile(join(outputs_path, f))]
         #model_path = "/Users/esgardner/PycharmProjects/" + args.year # for running locally
         model_path = os.path.join(data_store["human_summaries"], args.split, "2009")
-        model_files = [f for f in os.listdir(model_path) if isfile(join(model_path, f)) and '-A' in f]
+        model_files = [f for f in os.listdir(model_path) if isfile(join(model_path, f))
+                       and any(docset in f for docset in docsets)]
     else:
         outputs_path = os.path.join(data_store["{}_outdir".format(args.split)])
         if outputs_path.endswith("/"):
             outputs_path = outputs_path[:-1]
         output_files = [f for f in os.listdir(outputs_path) if isfile(join(outputs_path, f))]
         model_path = os.path.join(data_store["human_summaries"], args.split)
-        model_files = [f for f in os.listdir(model_path) if isfile(join(model_path, f)) and '-A' in f]
+        model_files = [f for f in os.listdir(model_path) if isfile(join(model_path, f))
+                       and any(docset in f for docset in docsets)]
 
     build_tree(outf, sorted(output_files), outputs_path, sorted(model_files), model_path)
 
@@ -99,6 +103,7 @@ if __name__ == "__main__":
     parser.add_argument("--split", type=str, default="training", choices=["devtest", "evaltest", "training"])
     parser.add_argument("--run_id", default=None)
     parser.add_argument("--test", default=False)
+    parser.add_argument("--update", action="store_true", help="also evaluate the summaries of docset B")
     args = parser.parse_args()
 
     with open(args.config) as infile:
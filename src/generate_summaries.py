@@ -18,6 +18,7 @@ PARENS_PATTERN = re.compile("[\(\[].*?[\)\]]")
 QUOTESPACE_PATTERN = re.compile('["] ([A-Za-z0-9])')
 SENTENCE_VERSIONS = dict() # multiple sentence versions, key: doc_index_index
 PRINT_REDUNDANT = False
+EMBEDDING_LOOKAHEAD = 4 # number of candidates whose embeddings are requested together
 
 
 def strip_which(line, n=7):
@@ -38,6 +39,31 @@ def strip_attribution(line, n=9):
     return line
 
 
+def passes_filters(sentence, sen_length, min_length=8, max_length=50):
+    """
+    Checks the filters a sentence has to pass before it is compared to the summary
+    Returns: True if the sentence can be added to a summary
+    """
+    # ignore short sentences
+    if sen_length <= min_length or sen_length > max_length:
+        return False
+
+    # ignore sentences containing capitalized words 
+    match = CAPS_PATTERN.search(sentence)
+    if match is not None:
+        return False
+     
+    # ignore sentences containing "/"
+    if "/" in sentence:
+        return False
+
+    # ignore sentences containing quotes
+    quotes = ('"', "''", "``")
+    if any(q in sentence for q in quotes):
+        return False
+    return True
+
+
 def make_summaries(topic_dict, embeddings, args, data_store, sim_threshold=0.95, min_length=8, max_length=50, num_sentences=20, use_embeddings=False):
     """
     given a topic dictionary, generates summaries for each topic
@@ -60,32 +86,18 @@ def make_summaries(topic_dict, embeddings, args, data_store, sim_threshold=0.95,
         full_summary = []  # without truncated sentences
         summ_length = 0
         sorted_sentences = sorted(topic_dict[topic_id], key=lambda x: (topic_dict[topic_id][x]['total']), reverse=True)
+        candidates = [sentence for sentence in sorted_sentences[:num_sentences]
+                      if passes_filters(sentence, topic_dict[topic_id][sentence]['length'], min_length, max_length)]
         
-        for orig_sentence in sorted_sentences[:num_sentences]:
+        for position, orig_sentence in enumerate(candidates):
             sentence = orig_sentence
 
             if summ_length >= 100:
                 break
 
-            # ignore short sentences
-            sen_length = topic_dict[topic_id][sentence]['length']
-
-            if sen_length <= min_length or sen_length > max_length:
-                continue
-
-            # ignore sentences containing capitalized words 
-            match = CAPS_PATTERN.search(sentence)
-            if match is not None:
-                continue
-             
-            # ignore sentences containing "/"
-            if "/" in sentence:
-                continue
-
-            # ignore sentences containing quotes
-            quotes = ('"', "''", "``")
-            if any(q in sentence for q in quotes):
-                continue
+            # lazily computed embeddings of the sentence and a few of the next candidates are computed
+            # together when one of them is compared
+            embeddings.request(candidates[position:position + EMBEDDING_LOOKAHEAD])
             
             # store original sentence version
             sentence_id = "{doc_index}_{index}".format(
@@ -114,6 +126,9 @@ def make_summaries(topic_dict, embeddings, args, data_store, sim_threshold=0.95,
 
 
 
+        # the remaining candidates are not compared
+        embeddings.cancel_requests()
+
         # do information ordering for summary
         best_summary = score_coherence(summary, full_summary, embeddings=embeddings)
         summary_dict[topic_id] = best_summary
@@ -267,10 +282,15 @@ def apply_heuristics_to_tokens(sentence):
 
 
 def write_to_file(out_dir, run_id, topic_id, sentences):
+    # update summaries of docset B have topic ids like D0901A-B
+    docset = "A"
+    if topic_id.endswith("-B"):
+        topic_id, docset = topic_id[:-2], "B"
     id_part_1 = topic_id[:-1]
     id_part_2 = topic_id[-1]
-    output_name = "{id_part_1}-A.M.100.{id_part_2}.{unique_alphanum}".format(
+    output_name = "{id_part_1}-{docset}.M.100.{id_part_2}.{unique_alphanum}".format(
         id_part_1=id_part_1,
+        docset=docset,
         id_part_2=id_part_2,
         unique_alphanum=run_id,
     )
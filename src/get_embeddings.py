@@ -1,55 +1,415 @@
 import torch
 from tqdm import tqdm 
-from transformers import BertTokenizer, BertModel
+from transformers import BertConfig, BertTokenizer, BertModel
+try:
+    from transformers import BertTokenizerFast
+except ImportError:
+    BertTokenizerFast = None
 # from transformers import AutoTokenizer, AutoModelWithLMHead
 import numpy as np
 from scipy.spatial.distance import cosine
 import pandas as pd
 import os
+import json
+import hashlib
 import random 
 import pickle
+from collections import OrderedDict
 
+from embedding_cache import EmbeddingCache, get_namespace
 
-def tokenize(sentence_list, model_name="bert-base-cased"):
-    tokenizer = BertTokenizer.from_pretrained(model_name)
+# how token vectors are pooled into sentence embeddings, part of the embedding cache keys
+POOLING = "mean"
+
+# tokenizers and models loaded in this process, by model name
+_TOKENIZERS = {}
+_MODELS = {}
+
+
+def get_tokenizer(model_name="bert-base-cased"):
+    """
+    Returns the tokenizer of a model, loaded once per process.
+    The fast (Rust) tokenizer is used when transformers has one.
+    """
+    if model_name not in _TOKENIZERS:
+        tokenizer_class = BertTokenizerFast if BertTokenizerFast is not None else BertTokenizer
+        _TOKENIZERS[model_name] = tokenizer_class.from_pretrained(model_name)
+    return _TOKENIZERS[model_name]
+
+
+def get_model(model_name="bert-base-cased", quantize=False):
+    """
+    Returns a pretrained model in evaluation mode, loaded once per process.
+    With quantize, the weights of its linear layers are dynamically
+    quantized to int8, which speeds up inference on CPU.
+    """
+    if (model_name, quantize) not in _MODELS:
+        model = BertModel.from_pretrained(model_name)
+        model.eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        _MODELS[(model_name, quantize)] = model
+    return _MODELS[(model_name, quantize)]
+
+
+def get_revision(model_name="bert-base-cased"):
+    """
+    Returns: identifier of the version of a model and its tokenizer,
+    part of the embedding cache keys. It is made of the commit hash
+    of the model where transformers resolves one, a hash of the
+    model configuration and the class of the tokenizer.
+    """
+    config = BertConfig.from_pretrained(model_name)
+    config_hash = hashlib.sha1(config.to_json_string().encode("utf-8")).hexdigest()
+    return "{}:{}:{}".format(getattr(config, "_commit_hash", None), config_hash,
+                             type(get_tokenizer(model_name)).__name__)
+
+
+def get_mode(quantize=False, max_seq_len=None):
+    """
+    Returns: name of the inference settings that change the
+    embeddings, part of their cache keys. None for the defaults,
+    i.e. a full precision model and full length sentences.
+    """
+    settings = []
+    if quantize:
+        settings.append("int8")
+    if max_seq_len is not None:
+        settings.append("max{}".format(max_seq_len))
+    return "_".join(settings) if settings else None
+
+
+def inference_context():
+    """
+    torch.inference_mode where torch has it (1.9 and later),
+    otherwise torch.no_grad.
+    """
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def tokenize(sentence_list, model_name="bert-base-cased", batch_size=1000, progress=True, max_seq_len=None):
+    """
+    Encodes sentences with the tokenizer of model_name, batch_size
+    sentences at a time, adding [CLS] and [SEP]. Sentences longer
+    than max_seq_len tokens are truncated, keeping the final [SEP],
+    so max_seq_len must be at least 2.
+
+    Returns: list of the token ids of every sentence, unpadded
+    (see make_batches).
+    """
+    if max_seq_len is not None and max_seq_len < 2:
+        raise ValueError("max_seq_len must be at least 2 to keep [CLS] and [SEP], got {}".format(max_seq_len))
+    tokenizer = get_tokenizer(model_name)
     inputs_list = []
-    for sentence in tqdm(sentence_list, desc="tokenizing"):
-        input_ids = torch.tensor(tokenizer.encode(sentence)).unsqueeze(0)
-        inputs_list.append(input_ids)
+    batches = range(0, len(sentence_list), batch_size)
+    for start in tqdm(batches, desc="tokenizing", disable=not progress):
+        batch = sentence_list[start:start + batch_size]
+        # later versions of transformers replace batch_encode_plus by calling the tokenizer
+        if hasattr(tokenizer, "batch_encode_plus"):
+            encoded = tokenizer.batch_encode_plus(batch, add_special_tokens=True)
+        else:
+            encoded = tokenizer(batch, add_special_tokens=True)
+        inputs_list.extend(encoded["input_ids"])
+    if max_seq_len is not None:
+        inputs_list = [ids if len(ids) <= max_seq_len else ids[:max_seq_len - 1] + ids[-1:] for ids in inputs_list]
     return inputs_list
 
 
-def make_embeddings(topic_sentences, pickle_path, model_name="bert-base-cased", overwrite=False):
+def make_batches(inputs_list, batch_size=32):
+    """
+    Groups tokenized sentences of similar length into batches, so that
+    they need little padding.
+
+    Returns: list of (indices, input_ids, attention_mask) where indices
+    are the positions of the batch's sentences in inputs_list. input_ids
+    are padded on the right with 0, the padding is masked out in
+    attention_mask so its value does not matter.
+    """
+    order = sorted(range(len(inputs_list)), key=lambda i: len(inputs_list[i]))
+    batches = []
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        max_length = max(len(inputs_list[i]) for i in indices)
+        input_ids = torch.zeros((len(indices), max_length), dtype=torch.long)
+        attention_mask = torch.zeros((len(indices), max_length), dtype=torch.long)
+        for row, i in enumerate(indices):
+            input_ids[row, :len(inputs_list[i])] = torch.tensor(inputs_list[i])
+            attention_mask[row, :len(inputs_list[i])] = 1
+        batches.append((indices, input_ids, attention_mask))
+    return batches
+
+
+def mean_pool(hidden_states, attention_mask):
+    """
+    Mean over the tokens of each sentence in the last hidden layer,
+    including [CLS] and [SEP] and excluding the padding.
+    """
+    mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+    return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+def embed_inputs(inputs_list, model, batch_size=32, progress=True):
+    """
+    Runs tokenized sentences through the model in batches of
+    batch_size (see make_batches).
+
+    Returns: float32 matrix with the embedding of inputs_list[i]
+    in row i.
+    """
+    matrix = np.zeros((len(inputs_list), model.config.hidden_size), dtype=np.float32)
+    batches = make_batches(inputs_list, batch_size)
+    for indices, input_ids, attention_mask in tqdm(batches, desc="embedding", disable=not progress):
+        with inference_context():
+            outputs = model(input_ids, attention_mask=attention_mask)
+            matrix[indices] = mean_pool(outputs[0], attention_mask).numpy()
+    return matrix
+
+
+def report_drift(sentence_list, matrix, model_name="bert-base-cased", batch_size=32):
+    """
+    Compares embeddings computed with other inference settings
+    (see get_mode) to the embeddings of the full precision model
+    on full length sentences, and prints the cosine drift.
+
+    The full precision model is loaded for the comparison only,
+    unless it is already loaded in this process.
+
+    Returns: array of the cosine distance between the two
+    embeddings of every sentence.
+    """
+    if (model_name, False) in _MODELS:
+        reference_model = _MODELS[(model_name, False)]
+    else:
+        reference_model = BertModel.from_pretrained(model_name)
+        reference_model.eval()
+    reference = embed_inputs(tokenize(sentence_list, model_name, progress=False), reference_model,
+                             batch_size, progress=False)
+    similarity = np.sum(reference * matrix, axis=1) / (np.linalg.norm(reference, axis=1) *
+                                                       np.linalg.norm(matrix, axis=1))
+    drift = 1 - similarity
+    print("cosine drift from fp32 over {} sentences: mean {:.6f}, max {:.6f}".format(
+        len(sentence_list), float(np.mean(drift)), float(np.max(drift))))
+    return drift
+
+
+class EmbeddingStore(object):
+    """
+    Sentence embeddings kept on disk as a float32 matrix in
+    <path>.npy, which is memory-mapped, and an index in <path>.json
+    that maps every sentence to its row. store[sentence] returns the
+    embedding of the sentence as a numpy array, so the store can be
+    used in place of the dict of tensors make_embeddings used to return.
+    """
+    def __init__(self, path):
+        with open(path + ".json") as infile:
+            self.index = json.load(infile)
+        # an empty file can not be memory-mapped
+        mmap_mode = "r" if self.index else None
+        self.matrix = np.load(path + ".npy", mmap_mode=mmap_mode)
+
+    def __getitem__(self, sentence):
+        return self.matrix[self.index[sentence]]
+
+    def __contains__(self, sentence):
+        return sentence in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def request(self, sentences):
+        """Every embedding is precomputed, so there is nothing to prepare"""
+        pass
+
+    def cancel_requests(self):
+        pass
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + ".npy") and os.path.exists(path + ".json")
+
+    @staticmethod
+    def write(path, sentences, matrix):
+        """
+        Writes the store of the embeddings in the rows of matrix.
+        Each file is written to a temporary file first and renamed
+        when complete, the index last.
+        """
+        with open(path + ".npy.tmp", "wb") as outfile:
+            np.save(outfile, np.asarray(matrix, dtype=np.float32))
+        os.replace(path + ".npy.tmp", path + ".npy")
+        with open(path + ".json.tmp", "w") as outfile:
+            json.dump({sentence: row for row, sentence in enumerate(sentences)}, outfile)
+        os.replace(path + ".json.tmp", path + ".json")
+
+
+def migrate_pickle(pickle_path, store_path):
+    """
+    Converts the dict of tensors saved by earlier versions of
+    make_embeddings with torch.save to an EmbeddingStore.
+    """
+    with open(pickle_path, "rb") as handle:
+        sentence_embeddings = torch.load(handle)
+    sentences = list(sentence_embeddings.keys())
+    matrix = np.stack([sentence_embeddings[sentence].numpy() for sentence in sentences]) if sentences else \
+        np.zeros((0, 0), dtype=np.float32)
+    EmbeddingStore.write(store_path, sentences, matrix)
+
+
+class LazyEmbeddings(object):
+    """
+    Computes sentence embeddings the first time they are accessed
+    and keeps them in memory, so only the sentences the summarizer
+    compares are run through BERT. Sentences passed to request()
+    are embedded together, in batches, on the first access of any
+    sentence that is not embedded yet. The model is loaded on the
+    first embedding.
+    """
+    def __init__(self, model_name="bert-base-cased", batch_size=32, cache=None, quantize=False, max_seq_len=None,
+                 drift_sample=0):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache = cache
+        self.quantize = quantize
+        self.max_seq_len = max_seq_len
+        self.drift_sample = drift_sample
+        self.embeddings = {}
+        self.pending = OrderedDict()
+
+    def request(self, sentences):
+        """Queues sentences that will be accessed"""
+        for sentence in sentences:
+            if sentence not in self.embeddings:
+                self.pending[sentence] = None
+
+    def cancel_requests(self):
+        """Drops the queued sentences that were not embedded yet"""
+        self.pending = OrderedDict()
+
+    def flush(self):
+        """Embeds the queued sentences"""
+        sentences = list(self.pending.keys())
+        self.pending = OrderedDict()
+        if self.cache is not None:
+            self.embeddings.update(self.cache.get_many(sentences))
+            sentences = [sentence for sentence in sentences if sentence not in self.embeddings]
+        if not sentences:
+            return
+        inputs_list = tokenize(sentences, self.model_name, progress=False, max_seq_len=self.max_seq_len)
+        matrix = embed_inputs(inputs_list, get_model(self.model_name, self.quantize), self.batch_size, progress=False)
+        for sentence, embed in zip(sentences, matrix):
+            self.embeddings[sentence] = embed
+        if self.cache is not None:
+            self.cache.put_many(sentences, matrix)
+
+    def __getitem__(self, sentence):
+        if sentence not in self.embeddings:
+            self.request([sentence])
+            self.flush()
+        return self.embeddings[sentence]
+
+    def __contains__(self, sentence):
+        return sentence in self.embeddings
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def report_drift(self):
+        """
+        Reports the cosine drift from full precision embeddings (see
+        report_drift) for a random sample of drift_sample of the
+        embedded sentences, if they were quantized or truncated.
+        """
+        if get_mode(self.quantize, self.max_seq_len) is None or self.drift_sample <= 0:
+            return None
+        if not self.embeddings:
+            print("no sentences were embedded, the cosine drift from fp32 is not reported")
+            return None
+        sentences = sorted(self.embeddings.keys())
+        sample = random.Random(0).sample(sentences, min(self.drift_sample, len(sentences)))
+        matrix = np.stack([self.embeddings[sentence] for sentence in sample])
+        return report_drift(sample, matrix, self.model_name, self.batch_size)
+
+
+def make_embeddings(topic_sentences, store_path, model_name="bert-base-cased", overwrite=False, batch_size=32,
+                    lazy=False, cache_path=None, num_threads=None, quantize=False, max_seq_len=None,
+                    drift_sample=0):
     """
     Given a list of sentences, return their embeddings.
     The embeddings are a mean over the last hidden layer of 
     a pretrained BERT model.
+    Sentences are run through the model in padded batches of
+    batch_size sentences of similar length.
+    The embeddings are saved as an EmbeddingStore in store_path.
+    An embeddings pickle of an earlier version in
+    store_path + ".pickle" is converted instead of recomputed.
+    If lazy is True and there is no store yet, nothing is computed
+    up front and a LazyEmbeddings is returned instead.
+    If cache_path is given, embeddings are taken from the
+    EmbeddingCache there, and only the other sentences are run
+    through BERT and added to it.
+    For CPU inference, num_threads sets the number of torch threads,
+    quantize uses int8 linear layers and max_seq_len truncates long
+    sentences. With either of the last two, the cosine drift from
+    full precision embeddings is reported for a random sample of
+    drift_sample sentences; for LazyEmbeddings once its
+    report_drift() is called.
 
-    Returns: dict where keys are sentences, and values 
-    are embeddings.
+    Returns: EmbeddingStore or LazyEmbeddings, embeddings[sentence]
+    is the embedding of the sentence.
     """
-    if os.path.exists(pickle_path) and not overwrite:
-        with open(pickle_path, "rb") as handle:
-            return torch.load(handle)
+    if max_seq_len is not None and max_seq_len < 2:
+        raise ValueError("max_seq_len must be at least 2 to keep [CLS] and [SEP], got {}".format(max_seq_len))
+    if not overwrite:
+        if not EmbeddingStore.exists(store_path) and os.path.exists(store_path + ".pickle"):
+            print("converting {}.pickle".format(store_path))
+            migrate_pickle(store_path + ".pickle", store_path)
+        if EmbeddingStore.exists(store_path):
+            store = EmbeddingStore(store_path)
+            # the selected sentences change with the selection settings, e.g. the number of LDA topics
+            if all(sentence in store for inner_dict in topic_sentences.values() for sentence in inner_dict):
+                return store
+            print("{} is missing some of the selected sentences, embedding again".format(store_path))
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    mode = get_mode(quantize, max_seq_len)
+    cache = None
+    if cache_path is not None:
+        cache = EmbeddingCache(cache_path, get_namespace(model_name, POOLING, mode, get_revision(model_name)))
+    if lazy:
+        return LazyEmbeddings(model_name, batch_size, cache=cache, quantize=quantize, max_seq_len=max_seq_len,
+                              drift_sample=drift_sample)
     
     sentence_list = []
     for inner_dict in topic_sentences.values():
         sentence_list.extend(inner_dict.keys())
+    sentence_list = list(OrderedDict.fromkeys(sentence_list))
 
-    inputs_list = tokenize(sentence_list)
-    model = BertModel.from_pretrained(model_name)
-    sentence_embeddings = {}
-    for sentence, input_ids in tqdm(zip(sentence_list, inputs_list), desc="embedding"):
-        with torch.no_grad():
-            outputs = model(input_ids)
-            embed = torch.mean(outputs[0], dim=0)
-            embed = torch.mean(embed, dim=0)
-            sentence_embeddings[sentence] = embed
-    
-    with open(pickle_path, "wb") as handle:
-        # pickle.dump(sentence_embeddings, handle)
-        torch.save(sentence_embeddings, handle, pickle_protocol=2)
-    return sentence_embeddings
+    sentence_embeddings = {} if cache is None else cache.get_many(sentence_list)
+    missing = [sentence for sentence in sentence_list if sentence not in sentence_embeddings]
+    print("{} of {} sentences are in the embedding cache".format(len(sentence_embeddings), len(sentence_list)))
+    if missing:
+        inputs_list = tokenize(missing, model_name, max_seq_len=max_seq_len)
+        missing_matrix = embed_inputs(inputs_list, get_model(model_name, quantize), batch_size)
+        sentence_embeddings.update(zip(missing, missing_matrix))
+        if cache is not None:
+            cache.put_many(missing, missing_matrix)
+    if cache is not None:
+        cache.close()
+
+    if sentence_list:
+        matrix = np.stack([sentence_embeddings[sentence] for sentence in sentence_list])
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    if mode is not None and drift_sample > 0 and sentence_list:
+        rows = sorted(random.Random(0).sample(range(len(sentence_list)), min(drift_sample, len(sentence_list))))
+        report_drift([sentence_list[row] for row in rows], matrix[rows], model_name, batch_size)
+    EmbeddingStore.write(store_path, sentence_list, matrix)
+    return EmbeddingStore(store_path)
 
 
 def test():
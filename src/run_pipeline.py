@@ -5,11 +5,11 @@ from datetime import datetime
 import time
 
 from data_loader import load_data
-from content_selection.preprocessing import preprocess 
+from content_selection.preprocessing import preprocess, SELECTION_FEATURES
 from content_selection.LDA import sentence_selection_wrapper
 from generate_eval_config import write_eval_config
 from generate_summaries import make_summaries
-from get_embeddings import make_embeddings
+from get_embeddings import make_embeddings, get_mode, LazyEmbeddings
 
 
 def run_module(desc, func, *args, **kwargs):
@@ -40,35 +40,59 @@ def run(args):
     if not os.path.exists(data_store["working_dir"]):
         os.makedirs(data_store["working_dir"])
 
+    # update summarization adds the B docsets, so its outputs are cached separately
+    docsets = ("A", "B") if args.update else ("A",)
+    cache_suffix = ".update" if args.update else ""
+
     input_data, xml_filename = run_module("loading input data", load_data, "input_data", data_store, 
-        args.split, test=args.test, overwrite=False)
+        args.split, test=args.test, overwrite=False, workers=args.load_workers, docsets=docsets)
 
     preprocessed_data = run_module(
         "loading preprocessed data", 
         preprocess, 
         input_data, 
-        os.path.join(data_store["working_dir"], os.path.basename(xml_filename)[:-4] + ".json.preprocessed"),
-        overwrite=False)
+        os.path.join(data_store["working_dir"], os.path.basename(xml_filename)[:-4] + ".json.preprocessed" + cache_suffix),
+        overwrite=False,
+        batch_size=args.spacy_batch_size,
+        n_process=args.spacy_processes,
+        stream=args.stream_preprocessing,
+        features=args.features if args.features is not None else data_store.get("features", SELECTION_FEATURES),
+        cache_path=os.path.join(data_store["working_dir"], "sentence_features.sqlite"))
 
 
     topic_sentences = run_module(
         "selecting content",
         sentence_selection_wrapper,
         preprocessed_data,
-        os.path.join(data_store["working_dir"], os.path.basename(xml_filename)[:-4] + ".json.selected"),
+        os.path.join(data_store["working_dir"], os.path.basename(xml_filename)[:-4]
+                     + ".json.selected.t{}".format(args.num_topics) + cache_suffix),
         num_sentences=args.num_sentences,
         overwrite=False,
-        random_state = args.random_state
+        random_state = args.random_state,
+        workers=args.lda_workers,
+        num_topics=args.num_topics,
+        model_cache_dir=os.path.join(data_store["working_dir"], "lda_models"),
+        update=args.update
     )
 
+    # embeddings computed with quantization or truncation are stored separately
+    embedding_mode = get_mode(args.quantize_embeddings, args.max_seq_len)
+    mode_suffix = "_" + embedding_mode if embedding_mode is not None else ""
     bert_embeddings = run_module(
         "getting sentence embeddings",
         make_embeddings,
         topic_sentences=topic_sentences,
-        pickle_path=os.path.join(data_store["working_dir"], 
-            "{}_{}_{}.pickle".format(args.model_name, args.deliverable, args.split)),
+        store_path=os.path.join(data_store["working_dir"], 
+            "{}{}_{}_{}{}".format(args.model_name, mode_suffix, args.deliverable, args.split, cache_suffix)),
         model_name=args.model_name,
         overwrite=False,
+        batch_size=args.embedding_batch_size,
+        lazy=args.lazy_embeddings,
+        cache_path=os.path.join(data_store["working_dir"], "embeddings.sqlite"),
+        num_threads=args.embedding_threads,
+        quantize=args.quantize_embeddings,
+        max_seq_len=args.max_seq_len,
+        drift_sample=args.embedding_drift_sample,
     )
 
     run_module(
@@ -80,6 +104,10 @@ def run(args):
         num_sentences=args.num_sentences,
     )
 
+    # lazily computed embeddings are only known once the summaries are generated
+    if isinstance(bert_embeddings, LazyEmbeddings):
+        bert_embeddings.report_drift()
+
     run_module(
         "writing eval config",
         write_eval_config,
@@ -96,10 +124,38 @@ if __name__ == "__main__":
     parser.add_argument("--test", action="store_true")
     parser.add_argument("--use_embeddings", action="store_true")
     parser.add_argument("--model_name", default="bert-base-cased")
+    parser.add_argument("--embedding_batch_size", type=int, default=32,
+        help="number of sentences per BERT batch when computing embeddings")
+    parser.add_argument("--lazy_embeddings", action="store_true",
+        help="only embed the sentences that are compared while generating summaries")
+    parser.add_argument("--embedding_threads", type=int, default=None,
+        help="number of CPU threads used by torch for the embeddings")
+    parser.add_argument("--quantize_embeddings", action="store_true",
+        help="compute embeddings with int8 dynamically quantized linear layers")
+    parser.add_argument("--max_seq_len", type=int, default=None,
+        help="truncate sentences to this many tokens (at least 2) before embedding them")
+    parser.add_argument("--embedding_drift_sample", type=int, default=100,
+        help="number of sentences used to report the cosine drift of quantized or truncated embeddings")
     parser.add_argument("--sim_threshold", type=float, default=0.95)
     parser.add_argument("--num_sentences", type=int, default=20)
     parser.add_argument("--random_state", type=int, default=1)
+    parser.add_argument("--load_workers", type=int, default=1, help="number of processes used to fetch documents")
+    parser.add_argument("--spacy_batch_size", type=int, default=100, help="number of texts per nlp.pipe batch")
+    parser.add_argument("--spacy_processes", type=int, default=1, help="number of processes used by nlp.pipe")
+    parser.add_argument("--stream_preprocessing", action="store_true",
+        help="extract features while annotating instead of keeping every spaCy doc in memory")
+    parser.add_argument("--num_topics", type=int, default=3, help="number of LDA topics per topic cluster")
+    parser.add_argument("--update", action="store_true",
+        help="update summarization: also summarize docset B, with LDA models warm started from docset A")
+    parser.add_argument("--lda_workers", type=int, default=1, help="number of processes that train the LDA models")
+    parser.add_argument("--features", nargs="*", default=None,
+        help="optional sentence features to extract in preprocessing, defaults to the features in the config. "
+             "The features used by content selection are always extracted")
     args = parser.parse_args()
+    if args.num_topics < 1:
+        parser.error("--num_topics must be at least 1")
+    if args.max_seq_len is not None and args.max_seq_len < 2:
+        parser.error("--max_seq_len must be at least 2, the [CLS] and [SEP] tokens")
     run(args)
 
 